@@ -1,23 +1,32 @@
 #!/usr/bin/env python3
 
+import calendar
+import concurrent.futures
+import contextlib
 import datetime
+import functools
 import json
 import os
 import os.path
-import pickle
+import shutil
 import sqlite3
+import time
 
 import arguments
 import dateutil.parser
-import httplib2
+import urllib3
 
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
 
 PROD = False
 TRACE = True
 
+# Constructing an isoparser is not free; share one.
+ISOPARSER = dateutil.parser.isoparser()
+
 
 def log(level, msg, *args):
     if PROD:
@@ -33,6 +42,27 @@ def make_date_iso(d):
     """
     return '-'.join('{:02d}'.format(int(p)) for p in d.split('-'))
 
+@functools.lru_cache(maxsize=1024)
+def ensure_dir(path):
+    """Creates directory path if needed.
+
+    Remembers recently created directories, as many items go into the same
+    directory.
+    """
+    os.makedirs(path, exist_ok=True)
+
+def creation_timestamp(item):
+    """Returns the creationTime of a mediaItem as UNIX timestamp.
+
+    The API returns times like 2019-01-04T10:11:12Z or 2019-01-04T10:11:12.123Z;
+    these are parsed by position, which is much faster than a general ISO 8601
+    parser. Fractional seconds are dropped.
+    """
+    t = item['mediaMetadata']['creationTime']
+    if len(t) < 20 or t[-1] != 'Z' or t[10] != 'T':
+        return int(ISOPARSER.isoparse(t).timestamp())
+    return calendar.timegm((int(t[0:4]), int(t[5:7]), int(t[8:10]), int(t[11:13]), int(t[14:16]), int(t[17:19]), 0, 0, 0))
+
 class TokenSource:
     """Return OAuth token for PhotosService to use.
 
@@ -55,33 +85,76 @@ class TokenSource:
         if self._clientsecret is None:
             if self._tokensfile and os.path.exists(self._tokensfile):
                 with open(self._tokensfile, 'rb') as f:
-                    creds = pickle.load(f)
+                    creds = self._load(f.read())
                     return creds
             elif self._db:
                 creds = self._db.get_credentials(self.CRED_ID)
                 if creds:
-                    creds = pickle.loads(creds)
+                    creds = self._load(creds)
                     return creds
         assert self._clientsecret is not None, 'Need --creds to proceed with authorization'
         flow = InstalledAppFlow.from_client_secrets_file(self._clientsecret, self.SCOPES)
         creds = flow.run_local_server()
-        if creds and self._tokensfile:
-            with open(self._tokensfile, 'wb') as f:
-                pickle.dump(creds, f)
-        if creds and self._db:
-            self._db.store_credentials(self.CRED_ID, pickle.dumps(creds))
+        if creds:
+            self._store(creds)
         return creds
 
+    def _load(self, serialized):
+        """Deserialize credentials stored as JSON.
 
-class PhotosService:
+        Older versions pickled the credentials; these are converted to JSON.
+        """
+        try:
+            return Credentials.from_authorized_user_info(json.loads(serialized), self.SCOPES)
+        except ValueError:
+            # Only needed for this one-time conversion.
+            import pickle
+            log('INFO', 'Converting stored credentials to JSON')
+            creds = pickle.loads(serialized)
+            self._store(creds)
+            return creds
+
+    def _store(self, creds):
+        if self._tokensfile:
+            with open(self._tokensfile, 'w') as f:
+                f.write(creds.to_json())
+        if self._db:
+            self._db.store_credentials(self.CRED_ID, creds.to_json())
 
-    def __init__(self, tokens=None):
+
+class PhotosService:
+    # mediaItems.batchGet accepts at most this many IDs per call.
+    BATCH_GET_SIZE = 50
+    # baseUrls are valid for 60 minutes after being fetched.
+    BASE_URL_TTL = 50 * 60
+    # How often to retry API calls and downloads after transient errors
+    # (429 and 5xx), with exponential backoff.
+    RETRIES = 5
+    # Number of parallel downloads, unless given to the constructor.
+    DOWNLOAD_WORKERS = 16
+    # Largest page size the API allows for mediaItems.search.
+    PAGE_SIZE = 100
+    # Fields of listed items that are actually used.
+    LIST_FIELDS = 'nextPageToken,mediaItems(id,filename,mimeType,mediaMetadata(creationTime,video))'
+
+    def __init__(self, tokens=None, workers=None):
         self._token_source = tokens
         self._service = build('photoslibrary', 'v1', credentials=tokens.creds())
-        self._http = httplib2.Http()
+        workers = workers or self.DOWNLOAD_WORKERS
+        # Shared by the download threads. Media is served from a few hosts
+        # only; keep enough connections to each of them around for all
+        # threads, so that TLS sessions are reused. Transient errors are
+        # retried here, waiting as long as the server asks us to in
+        # Retry-After; if they persist, the final response is returned.
+        self._http = urllib3.PoolManager(num_pools=4, maxsize=workers, block=False,
+                retries=urllib3.Retry(total=self.RETRIES, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                    respect_retry_after_header=True, raise_on_status=False))
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        # id -> (fetch time, mediaItem), for retrying failed downloads.
+        self._refreshed = {}
 
     def get_item(self, id):
-        item = self._service.mediaItems().get(mediaItemId=id).execute()
+        item = self._service.mediaItems().get(mediaItemId=id).execute(num_retries=self.RETRIES)
         return item
 
     def list_library(self, start=None, to=None):
@@ -90,10 +163,25 @@ class PhotosService:
         Arguments:
             start: datetime.date
             end: datetime.date
-            
+
         Returns:
             [mediaItem]
         """
+        for page in self.list_library_pages(start, to):
+            yield from page
+
+    def list_library_pages(self, start=None, to=None):
+        """Yields items from the library, one list per page of results.
+
+        Only the fields in LIST_FIELDS are returned for each item.
+
+        Arguments:
+            start: datetime.date
+            end: datetime.date
+            
+        Returns:
+            [[mediaItem]]
+        """
         filters = {}
         if start or to:
             rng_filter = {'ranges': {}}
@@ -104,23 +192,31 @@ class PhotosService:
             rng_filter['ranges']['startDate'] = {'year': start.year, 'month': start.month, 'day': start.day}
             rng_filter['ranges']['endDate'] = {'year': to.year, 'month': to.month, 'day': to.day}
             filters['dateFilter'] = rng_filter
-        pagetoken = None
+
+        def search(pagetoken):
+            return self._service.mediaItems().search(body={'pageSize': self.PAGE_SIZE, 'filters': filters, 'pageToken': pagetoken},
+                    fields=self.LIST_FIELDS).execute(num_retries=self.RETRIES)
 
         # Photos are returned in reversed order of creationTime.
-        while True:
-            resp = self._service.mediaItems().search(body={'pageSize': 75, 'filters': filters, 'pageToken': pagetoken}).execute()
-            pagetoken = resp.get('nextPageToken', None)
-            items = resp.get('mediaItems', None)
-            if not items:
-                return
-            for i in items:
-                log('TRACE', i['mediaMetadata']['creationTime'])
-                yield i
-            if pagetoken is None:
-                return
+        # The next page is requested while the caller processes the current
+        # one; there is never more than one request in flight.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as prefetcher:
+            resp = search(None)
+            while True:
+                pagetoken = resp.get('nextPageToken', None)
+                items = resp.get('mediaItems', None)
+                if not items:
+                    return
+                next_resp = prefetcher.submit(search, pagetoken) if pagetoken else None
+                for i in items:
+                    log('TRACE', i['mediaMetadata']['creationTime'])
+                yield items
+                if next_resp is None:
+                    return
+                resp = next_resp.result()
 
     def download_items(self, items):
-        """Download multiple items.
+        """Download multiple items concurrently.
 
         Arguments:
             items: List of (id, path, video) tuples.
@@ -128,129 +224,349 @@ class PhotosService:
         Returns:
             List of IDs that were successfully downloaded.
         """
-        ids = [i[0] for i in items]
-        media_items = self._service.mediaItems().batchGet(mediaItemIds=ids).execute()
-        ok = []
-        i = -1
-        for result in media_items['mediaItemResults']:
-            i += 1
-            if 'status' in result:
-                log('WARN', 'Could not query info for {}: {}'.format(items[i][0], result['status']))
-                continue
-            item = result['mediaItem']
-            rawurl = item['baseUrl']
-            if 'video' in item['mediaMetadata']:
-                rawurl += '=dv'
+        futures = self.start_downloads(items)
+        return [f.result() for f in futures.values() if f.result()]
+
+    def start_downloads(self, items):
+        """Start downloading multiple items in the background.
+
+        Arguments:
+            items: List of (id, path, video) tuples.
+
+        Returns:
+            {id: Future} for all items that could be found. Each future
+            resolves to the result of download_item().
+        """
+        media_items = self.batch_refresh([i[0] for i in items])
+        return {i[0]: self._executor.submit(self.download_item, media_items[i[0]], i[1])
+                for i in items if i[0] in media_items}
+
+    def batch_refresh(self, ids):
+        """Fetch mediaItems with a current baseUrl.
+
+        Items refreshed less than BASE_URL_TTL seconds ago are not fetched
+        again.
+
+        Arguments:
+            ids: List of media item IDs.
+
+        Returns:
+            {id: mediaItem} for all items that could be found.
+        """
+        now = time.monotonic()
+        result = {}
+        missing = []
+        for id in ids:
+            cached = self._refreshed.get(id)
+            if cached and now - cached[0] < self.BASE_URL_TTL:
+                result[id] = cached[1]
             else:
-                rawurl += '=d'
-            os.makedirs(items[i][1], exist_ok=True)
-            p = os.path.join(items[i][1], item['filename'])
-            log('INFO', 'Downloading {}', p)
-            resp, cont = self._http.request(rawurl, 'GET')
+                missing.append(id)
+        for i in range(0, len(missing), self.BATCH_GET_SIZE):
+            chunk = missing[i:i + self.BATCH_GET_SIZE]
+            media_items = self._service.mediaItems().batchGet(mediaItemIds=chunk).execute(num_retries=self.RETRIES)
+            for (id, r) in zip(chunk, media_items['mediaItemResults']):
+                if 'status' in r:
+                    log('WARN', 'Could not query info for {}: {}'.format(id, r['status']))
+                    continue
+                result[id] = r['mediaItem']
+                self._refreshed[id] = (now, r['mediaItem'])
+        return result
+
+    def download_item(self, item, path):
+        """Download a single item into the directory path.
+
+        Arguments:
+            item: mediaItem with a fresh baseUrl.
+            path: Directory to store the file in.
+
+        Returns:
+            The item ID if the download succeeded, otherwise None.
+        """
+        rawurl = item['baseUrl']
+        if 'video' in item['mediaMetadata']:
+            rawurl += '=dv'
+        else:
+            rawurl += '=d'
+        p = os.path.join(path, item['filename'])
+        log('INFO', 'Downloading {}', p)
+        try:
+            # Stream to disk; videos can be larger than available memory.
+            resp = self._http.request('GET', rawurl, preload_content=False)
+        except urllib3.exceptions.HTTPError as e:
+            log('WARN', 'HTTP item download failed: {}'.format(e))
+            return None
+        try:
             if resp.status != 200:
                 log('WARN', 'HTTP item download failed: {} {}'.format(resp.status, resp.reason))
-                continue
-            with open(p, 'wb') as f:
-                f.write(cont)
-            size = len(cont) / (1024. * 1024.)
-            log('INFO', 'Downloaded {} successfully ({:.2f} MiB)', p, size)
-            ok.append(item['id'])
-        return ok
+                return None
+            # Items with the same filename may be downloaded at the same time.
+            # Each one goes to its own temporary file, which replaces p once it
+            # is complete. A leftover from an earlier, killed run is overwritten.
+            ensure_dir(path)
+            tmp = os.path.join(path, '.{}.part'.format(item['id']))
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    shutil.copyfileobj(resp, f, length=1 << 20)
+                    size = f.tell() / (1024. * 1024.)
+                os.replace(tmp, p)
+            except BaseException:
+                # Don't leave partial downloads behind.
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(tmp)
+                raise
+        except urllib3.exceptions.HTTPError as e:
+            log('WARN', 'HTTP item download failed: {}'.format(e))
+            return None
+        except OSError as e:
+            log('WARN', 'Could not write {}: {}'.format(p, e))
+            if isinstance(e, FileNotFoundError):
+                # The directory was removed after ensure_dir() created it.
+                ensure_dir.cache_clear()
+            return None
+        finally:
+            resp.release_conn()
+        log('INFO', 'Downloaded {} successfully ({:.2f} MiB)', p, size)
+        self._refreshed.pop(item['id'], None)
+        return item['id']
 
 
 class DB:
+    # Statements used in loops. sqlite3 caches prepared statements by their
+    # text, so these are compiled only once per connection.
+    INSERT_ITEM = 'INSERT OR IGNORE INTO items (id, creationTime, path, mimetype, filename, video, offline) VALUES (?, ?, ?, ?, ?, ?, 0)'
+    INSERT_TRANSACTION = 'INSERT INTO transactions (id, type, time) VALUES (?, ?, ?)'
 
     def __init__(self, path):
-        self._db = sqlite3.connect(path)
+        # Transactions are managed explicitly, see transaction().
+        self._db = sqlite3.connect(path, isolation_level=None, cached_statements=256)
+        # Used for all writes and short reads.
+        self._cursor = self._db.cursor()
+        # Nesting level of transaction().
+        self._depth = 0
+        self.configure()
         self.initdb()
-        self._dtparse = dateutil.parser.isoparser()
+        self._load_known_ids()
+
+    def _load_known_ids(self):
+        # IDs of all items in the database. Most listed items are usually
+        # known already, and this avoids a lookup for each of them.
+        self._known_ids = set(row[0] for row in self._db.execute('SELECT id FROM items'))
+
+    def configure(self):
+        """Set per-connection options.
+
+        We are the only writer, and most writes are small appends, so use a
+        write-ahead log with relaxed syncing (still safe against application
+        crashes), and give SQLite a larger cache.
+        """
+        cur = self._db.cursor()
+        # Lets maintenance() return free pages to the file system. Only takes
+        # effect when the database is created, so it has to come first; older
+        # databases are converted by maintenance().
+        cur.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cur.execute('PRAGMA journal_mode = WAL')
+        cur.execute('PRAGMA synchronous = NORMAL')
+        cur.execute('PRAGMA temp_store = MEMORY')
+        cur.execute('PRAGMA cache_size = -65536')
+        cur.execute('PRAGMA mmap_size = 268435456')
+        cur.close()
 
     def initdb(self):
+        """Create tables if they don't exist yet.
+
+        Note that in WAL mode, SQLite keeps the files sync.db-wal and
+        sync.db-shm next to the database while it is open.
+        """
         cur = self._db.cursor()
-        cur.execute('CREATE TABLE IF NOT EXISTS items (id TEXT PRIMARY KEY, creationTime TEXT, path TEXT, mimetype \
-                TEXT, filename TEXT, video INTEGER, offline INTEGER)')
+        # Items are keyed by their (long) media item ID; storing rows in the
+        # primary key B-tree avoids a separate index on it.
+        items_columns = '(id TEXT PRIMARY KEY, creationTime TEXT, path TEXT, mimetype \
+                TEXT, filename TEXT, video INTEGER, offline INTEGER) WITHOUT ROWID'
+        cur.execute('SELECT sql FROM sqlite_master WHERE type = ? AND name = ?', ('table', 'items'))
+        row = cur.fetchone()
+        if row and 'WITHOUT ROWID' not in row[0].upper():
+            log('INFO', 'Migrating items table to WITHOUT ROWID')
+            cur.execute('BEGIN')
+            cur.execute('CREATE TABLE items_new ' + items_columns)
+            cur.execute('INSERT INTO items_new SELECT id, creationTime, path, mimetype, filename, video, offline FROM items')
+            # Also drops the old indexes, which are recreated below.
+            cur.execute('DROP TABLE items')
+            cur.execute('ALTER TABLE items_new RENAME TO items')
+            cur.execute('COMMIT')
+        cur.execute('CREATE TABLE IF NOT EXISTS items ' + items_columns)
+        # Serves get_items_by_downloaded() without sorting...
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_items_offline_ctime ON items (offline, creationTime)')
+        # ...and existing_items_range() without scanning.
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_items_ctime ON items (creationTime)')
         cur.execute('CREATE TABLE IF NOT EXISTS transactions (id TEXT, type TEXT, time INTEGER)')
-        cur.execute('CREATE TABLE IF NOT EXISTS oauth (id TEXT PRIMARY KEY, credentials BLOB)')
-        self._db.commit()
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_tx_id_time ON transactions (id, time)')
+        cur.execute('CREATE TABLE IF NOT EXISTS oauth (id TEXT PRIMARY KEY, credentials TEXT)')
+
+    def maintenance(self):
+        """Shrink the database file and truncate the write-ahead log.
+
+        Databases created before auto_vacuum was enabled are converted by a
+        one-time VACUUM, which rewrites the whole file.
+        """
+        self._cursor.execute('PRAGMA auto_vacuum')
+        if self._cursor.fetchone()[0] != 2:
+            log('INFO', 'Enabling incremental vacuum; this may take a while')
+            self._cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            # Can't run inside a transaction.
+            self._cursor.execute('VACUUM')
+        self._cursor.execute('PRAGMA incremental_vacuum')
+        self._cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        self._cursor.execute('PRAGMA optimize')
+        self._cursor.close()
+        self._db.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Yield the shared cursor inside a write transaction.
+
+        Transactions nest: the outermost one issues BEGIN IMMEDIATE and
+        COMMIT, inner ones use savepoints. If an exception escapes a
+        transaction, only its own writes are rolled back.
+        """
+        savepoint = 'sp{}'.format(self._depth)
+        if self._depth == 0:
+            self._cursor.execute('BEGIN IMMEDIATE')
+        else:
+            self._cursor.execute('SAVEPOINT ' + savepoint)
+        self._depth += 1
+        try:
+            yield self._cursor
+        except BaseException:
+            self._depth -= 1
+            if self._depth == 0:
+                self._cursor.execute('ROLLBACK')
+            else:
+                self._cursor.execute('ROLLBACK TO ' + savepoint)
+                self._cursor.execute('RELEASE ' + savepoint)
+            # Rolled back items have to be added again.
+            self._load_known_ids()
+            raise
+        self._depth -= 1
+        if self._depth == 0:
+            self._cursor.execute('COMMIT')
+        else:
+            self._cursor.execute('RELEASE ' + savepoint)
 
     def store_credentials(self, id, creds):
-        with self._db as conn:
-            cur = conn.cursor()
-            cur.execute('SELECT id FROM oauth WHERE id = ?', (id,))
-            if not cur.fetchone():
-                cur.execute('INSERT INTO oauth (id, credentials) VALUES (?, ?)', (id, creds))
-                return
-            cur.close()
-            cur = conn.cursor()
-            cur.execute('UPDATE oauth SET credentials = ? WHERE id = ?', (creds, id))
+        with self.transaction() as cur:
+            cur.execute('INSERT INTO oauth (id, credentials) VALUES (?, ?) \
+                    ON CONFLICT (id) DO UPDATE SET credentials = excluded.credentials', (id, creds))
 
     def get_credentials(self, id):
-        with self._db as conn:
-            cur = conn.cursor()
-            cur.execute('SELECT credentials FROM oauth WHERE id = ?', (id,))
-            row = cur.fetchone()
-            if row:
-                return row[0]
-            return None
+        self._cursor.execute('SELECT credentials FROM oauth WHERE id = ?', (id,))
+        row = self._cursor.fetchone()
+        if row:
+            return row[0]
+        return None
 
-    def add_online_item(self, media_item, path):
-        with self._db as conn:
-            cur = conn.cursor()
-            cur.execute('SELECT id FROM items WHERE id = "{}"'.format(media_item['id']))
-            if cur.fetchone():
+    def add_online_item(self, media_item, path, creation_time=None):
+        """Add item to the database unless it is already known.
+
+        creation_time is the item's creationTime as UNIX timestamp; it is parsed
+        from media_item if not given.
+        """
+        if media_item['id'] in self._known_ids:
+            log('INFO', 'Photo already in store.')
+            return False
+        if creation_time is None:
+            creation_time = creation_timestamp(media_item)
+        is_video = 1 if 'video' in media_item['mediaMetadata'] else 0
+        with self.transaction() as cur:
+            cur.execute(self.INSERT_ITEM, (media_item['id'], creation_time, path, media_item['mimeType'], media_item['filename'], is_video))
+            if cur.rowcount != 1:
                 log('INFO', 'Photo already in store.')
-                cur.close()
+                self._known_ids.add(media_item['id'])
                 return False
-            log('INFO', 'Inserting item {}'.format(media_item['id']))
-            cur.close()
-
-            creation_time = int(self._dtparse.isoparse(media_item['mediaMetadata']['creationTime']).timestamp())
-            is_video = 1 if 'video' in media_item['mediaMetadata'] else 0
-            conn.cursor().execute('INSERT INTO items (id, creationTime, path, mimetype, filename, video, offline) VALUES (?, ?, ?, ?, ?, ?, 0)', (media_item['id'], creation_time, path, media_item['mimeType'], media_item['filename'], is_video))
-        self.record_transaction(media_item['id'], 'ADD')
+            self.record_transaction(media_item['id'], 'ADD', cur)
+        self._known_ids.add(media_item['id'])
+        log('INFO', 'Inserted item {}'.format(media_item['id']))
         return True
 
-    def get_items_by_downloaded(self, downloaded=False):
-        """Generate items (as [id, path, filename, is_video]) that are not yet present locally."""
-        with self._db as conn:
-            cur = conn.cursor()
-            cur.execute('SELECT id, path, filename, video FROM items WHERE offline = ? ORDER BY creationTime ASC', (1 if downloaded else 0,))
-            while True:
-                row = cur.fetchone()
-                if not row:
-                    break
-                yield row
+    def add_online_items_bulk(self, items):
+        """Add several items at once, skipping those already known.
+
+        Arguments:
+            items: List of (mediaItem, path, creation_time) tuples, as in
+                add_online_item().
+
+        Returns:
+            List of the mediaItems that were added.
+        """
+        new = []
+        for item in items:
+            if item[0]['id'] not in self._known_ids:
+                self._known_ids.add(item[0]['id'])
+                new.append(item)
+        if not new:
+            return []
+        with self.transaction() as cur:
+            cur.executemany(self.INSERT_ITEM,
+                    [(m['id'], ct, path, m['mimeType'], m['filename'], 1 if 'video' in m['mediaMetadata'] else 0) for (m, path, ct) in new])
+            now = int(datetime.datetime.now().timestamp())
+            cur.executemany(self.INSERT_TRANSACTION, [(m['id'], 'ADD', now) for (m, _, _) in new])
+        return [m for (m, _, _) in new]
+
+    def get_items_by_downloaded(self, downloaded=False, page_size=1000):
+        """Generate items (as [id, path, filename, is_video]) that are not yet present locally.
+
+        Items are read in pages of page_size, and no statement is left running
+        while the caller processes them. That way, callers can safely change
+        items while iterating.
+        """
+        offline = 1 if downloaded else 0
+        self._cursor.execute('SELECT id, path, filename, video, creationTime FROM items WHERE offline = ? \
+                ORDER BY creationTime, id LIMIT ?', (offline, page_size))
+        rows = self._cursor.fetchall()
+        while rows:
+            for row in rows:
+                yield row[:4]
+            (id, creation_time) = (rows[-1][0], rows[-1][4])
+            self._cursor.execute('SELECT id, path, filename, video, creationTime FROM items WHERE offline = ? \
+                    AND (creationTime, id) > (?, ?) ORDER BY creationTime, id LIMIT ?', (offline, creation_time, id, page_size))
+            rows = self._cursor.fetchall()
 
     def mark_items_downloaded(self, ids, downloaded=True):
-        with self._db as conn:
-            for id in ids:
-                conn.cursor().execute('UPDATE items SET offline = ? WHERE id = ?', (1 if downloaded else 0, id))
-                self.record_transaction(id, 'DOWNLOAD')
+        if not ids:
+            return
+        now = int(datetime.datetime.now().timestamp())
+        with self.transaction() as cur:
+            cur.executemany('UPDATE items SET offline = ? WHERE id = ?', [(1 if downloaded else 0, id) for id in ids])
+            cur.executemany(self.INSERT_TRANSACTION, [(id, 'DOWNLOAD', now) for id in ids])
 
     def existing_items_range(self):
-        with self._db as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT creationTime FROM items ORDER BY creationTime DESC LIMIT 1')
-            newest = cursor.fetchone()
-            cursor.execute('SELECT creationTime FROM items ORDER BY creationTime ASC LIMIT 1')
-            oldest = cursor.fetchone()
-
-            # Safe defaults that will lead to all items being selected
-            old_default = datetime.datetime.now()
-            new_default = datetime.datetime.fromtimestamp(0)
-            return (
-                datetime.datetime.fromtimestamp(int(oldest[0])) if oldest else old_default,
-                datetime.datetime.fromtimestamp(int(newest[0])) if newest else new_default
-            )
-
-    def record_transaction(self, id, typ):
+        # Two scalar subqueries instead of MIN(), MAX() in one SELECT: SQLite
+        # only turns a lone MIN or MAX into an index probe.
+        self._cursor.execute('SELECT (SELECT MIN(creationTime) FROM items), (SELECT MAX(creationTime) FROM items)')
+        (oldest, newest) = self._cursor.fetchone()
+
+        # Safe defaults that will lead to all items being selected
+        old_default = datetime.datetime.now()
+        new_default = datetime.datetime.fromtimestamp(0)
+        return (
+            datetime.datetime.fromtimestamp(int(oldest)) if oldest is not None else old_default,
+            datetime.datetime.fromtimestamp(int(newest)) if newest is not None else new_default
+        )
+
+    def record_transaction(self, id, typ, cursor=None):
         """Record an event in the transaction log.
 
-        typ should be one of 'ADD', 'DOWNLOAD'.
+        typ should be one of 'ADD', 'DOWNLOAD'. If cursor is given, the event
+        is written as part of the transaction that cursor belongs to.
         """
-        with self._db as conn:
-            cursor = conn.cursor()
-            cursor.execute('INSERT INTO transactions (id, type, time) VALUES (?, ?, ?)', (id, typ, int(datetime.datetime.now().timestamp())))
+        if cursor is None:
+            with self.transaction() as cursor:
+                self.record_transaction(id, typ, cursor)
+            return
+        cursor.execute(self.INSERT_TRANSACTION, (id, typ, int(datetime.datetime.now().timestamp())))
 
 
 class Driver:
@@ -260,6 +576,9 @@ class Driver:
     2. Check for items not yet downloaded, download them.
     3. Start again.
     """
+    # Completed downloads are recorded in the database in batches of at least
+    # this size.
+    MARK_BATCH_SIZE = 32
 
     def __init__(self, db, photosservice, root='', path_mapper=None):
         self._root = root
@@ -292,40 +611,83 @@ class Driver:
         log('INFO', 'Running starting for {}'.format(date_range))
 
         for rng in ranges:
-            for item in self._svc.list_library(start=rng[0], to=rng[1]):
-                log('INFO', 'Fetched metadata for {}'.format(item['filename']))
-                if self._db.add_online_item(item, self._path_mapper(item)):
-                    log('INFO', 'Added {} to DB'.format(item['filename']))
+            for page in self._svc.list_library_pages(start=rng[0], to=rng[1]):
+                rows = []
+                for item in page:
+                    log('INFO', 'Fetched metadata for {}'.format(item['filename']))
+                    rows.append((item, self._path_mapper(item), creation_timestamp(item)))
+                # Only hold the write lock while writing, not while waiting
+                # for the next page.
+                with self._db.transaction():
+                    for item in self._db.add_online_items_bulk(rows):
+                        log('INFO', 'Added {} to DB'.format(item['filename']))
         return True
 
     def download_items(self):
-        """Scans database for items not yet downloaded and downloads them."""
+        """Scans database for items not yet downloaded and downloads them.
+
+        While one batch of items is downloading, the next one is looked up,
+        so that the download threads are kept busy.
+        """
         retry = []
-        chunk = []
-        chunksize = 16
-        for item in self._db.get_items_by_downloaded(False):
-            (id, path, filename, is_video) = item
-            path = os.path.join(self._root, path)
-            chunk.append((id, path, is_video))
-
-            if len(chunk) > chunksize:
-                ok = self._svc.download_items(chunk)
-                self._db.mark_items_downloaded(ok)
-                wantids = set(i[0] for i in chunk)
-                missing = wantids ^ set(ok)
-                for item in chunk:
-                    if item[0] in missing:
+        chunksize = self._svc.BATCH_GET_SIZE
+        # Downloaded, but not yet marked as such in the database.
+        downloaded = []
+        # Running downloads: Future -> (id, path, video).
+        pending = {}
+
+        def start(chunk):
+            if not chunk:
+                return
+            futures = self._svc.start_downloads(chunk)
+            for item in chunk:
+                if item[0] in futures:
+                    pending[futures[item[0]]] = item
+                else:
+                    retry.append(item)
+
+        def wait(limit):
+            """Wait until at most limit downloads are running."""
+            while len(pending) > limit:
+                (done, _) = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in done:
+                    item = pending.pop(f)
+                    if f.result():
+                        downloaded.append(item[0])
+                    else:
                         retry.append(item)
-                chunk = []
-
-        chunk.extend(retry)
-        n = chunksize
-        smalls = [chunk[i:i + n] for i in range(0, len(chunk), n)]
-        for chunk in smalls:
-            ok = self._svc.download_items(chunk)
-            self._db.mark_items_downloaded(ok)
-            if len(ok) < len(chunk):
-                log('WARN', 'Could not download {} items. Please try again later (photosync will automatically retry these)', len(chunk) - len(ok))
+                if len(downloaded) >= self.MARK_BATCH_SIZE:
+                    self._db.mark_items_downloaded(downloaded)
+                    downloaded.clear()
+
+        def run(items):
+            """Download items in batches, keeping up to two batches in flight."""
+            chunk = []
+            for item in items:
+                chunk.append(item)
+                if len(chunk) >= chunksize:
+                    start(chunk)
+                    chunk = []
+                    wait(chunksize)
+            start(chunk)
+            wait(0)
+
+        try:
+            run((id, os.path.join(self._root, path), is_video)
+                    for (id, path, filename, is_video) in self._db.get_items_by_downloaded(False))
+            # Give failed items a second chance.
+            failed = retry[:]
+            retry.clear()
+            run(failed)
+            if retry:
+                log('WARN', 'Could not download {} items. Please try again later (photosync will automatically retry these)', len(retry))
+        finally:
+            # Don't start anything else, but keep what has already finished.
+            for (f, item) in pending.items():
+                f.cancel()
+                if f.done() and not f.cancelled() and f.exception() is None and f.result():
+                    downloaded.append(item[0])
+            self._db.mark_items_downloaded(downloaded)
 
     def drive(self, date_range=(None, None), window_heuristic=True):
         """First, download all metadata since most recently fetched item.
@@ -343,17 +705,27 @@ class Driver:
 
         Marks them for download otherwise, meaning that they will be downloaded later.
         """
-        found = 0
-        for (id, path, filename, video) in self._db.get_items_by_downloaded(downloaded=True):
-            path = os.path.join(dir, path, filename)
+        def exists(path):
             try:
-                info = os.stat(path)
+                os.stat(path)
+                return True
             except FileNotFoundError:
-                log('INFO', 'Found vanished item at {}; marking for download', path)
-                found += 1
-                self._db.mark_items_downloaded([id], downloaded=False)
-        if found > 0:
-            log('WARN', 'Found {} vanished items. Reattempting download now...', found)
+                return False
+
+        items = [(id, os.path.join(dir, path, filename))
+                for (id, path, filename, video) in self._db.get_items_by_downloaded(downloaded=True)]
+        # Checking files one after another is bound by the latency of each
+        # stat() call, especially on spinning disks and network file systems.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=64) as executor:
+            present = executor.map(exists, [path for (id, path) in items])
+            vanished = []
+            for ((id, path), ok) in zip(items, present):
+                if not ok:
+                    log('INFO', 'Found vanished item at {}; marking for download', path)
+                    vanished.append(id)
+        self._db.mark_items_downloaded(vanished, downloaded=False)
+        if vanished:
+            log('WARN', 'Found {} vanished items. Reattempting download now...', len(vanished))
             return True
         return False
 
@@ -363,7 +735,11 @@ class Driver:
 
         Important: Omits the --dir relative directory (self._root).
         """
-        dt = dateutil.parser.isoparser().isoparse(item['mediaMetadata']['creationTime']).date()
+        t = item['mediaMetadata']['creationTime']
+        # Usually starts with a zero-padded YYYY-MM-DD; use that as is.
+        if t[4:5] == '-' and t[7:8] == '-':
+            return '{}/{}/{}/'.format(t[0:4], t[5:7], t[8:10])
+        dt = ISOPARSER.isoparse(t).date()
         return '{y}/{m:02d}/{d:02d}/'.format(y=dt.year, m=dt.month, d=dt.day)
 
 
@@ -397,6 +773,8 @@ class Main(arguments.BaseArguments):
             --dates=<dates>             Similar to --all, but only consider photos in the given date range: yyyy-mm-dd:yyyy-mm-dd or day: yyyy-mm-dd.
             --query=<item id>           Query metadata for item and print on console.
             --resync                    Check local filesystem for files that should be downloaded but are not there (anymore).
+            --maintenance               Shrink the database file and its write-ahead log, then exit.
+            --workers=<n>               Number of files to download in parallel. Defaults to 16.
         '''
         super(arguments.BaseArguments, self).__init__(doc=doc)
         self.dir = self.dir or '.'
@@ -404,38 +782,49 @@ class Main(arguments.BaseArguments):
 
     def main(self):
         # TODO: --resync, to inspect the local filesystem for vanished files.
-        db = DB(os.path.join(self.dir, 'sync.db'))
-        s = PhotosService(tokens=TokenSource(db=db, clientsecret=self.creds))
-        d = Driver(db, s, root=self.dir)
+        workers = None
+        if self.workers:
+            try:
+                workers = int(self.workers)
+            except ValueError:
+                workers = 0
+            if workers < 1:
+                print("Please use --workers with a number of at least 1.")
+                return
+        with contextlib.closing(DB(os.path.join(self.dir, 'sync.db'))) as db:
+            if self.maintenance:
+                db.maintenance()
+                return
+            s = PhotosService(tokens=TokenSource(db=db, clientsecret=self.creds), workers=workers)
+            d = Driver(db, s, root=self.dir)
 
-        if self.query:
-            print(s.get_item(self.query))
-            return
-        if self.resync:
-            if d.find_vanished_items(self.dir):
-                d.download_items()
-                log('WARN', 'Finished downloading missing items.')
-            return
-        if self.all:
-            d.drive(window_heuristic=False)
-        elif self.dates:
-            parts = self.dates.split(':')
-            p = dateutil.parser.isoparser()
-            window = None
-            if len(parts) == 2:
-                (a, b) = parts
-                (a, b) = (make_date_iso(a), make_date_iso(b))
-                (a, b) = p.isoparse(a), p.isoparse(b)
-                window = (a, b)
-            elif len(parts) == 1:
-                date = p.isoparse(make_date_iso(parts[0]))
-                window = (date, date)
-            else:
-                print("Please use --date with argument yyyy-mm-dd:yyyy-mm-dd (from:to) or yyyy-mm-dd.")
+            if self.query:
+                print(s.get_item(self.query))
                 return
-            d.drive(window_heuristic=False, date_range=window)
-        else:
-            d.drive(window_heuristic=True)
+            if self.resync:
+                if d.find_vanished_items(self.dir):
+                    d.download_items()
+                    log('WARN', 'Finished downloading missing items.')
+                return
+            if self.all:
+                d.drive(window_heuristic=False)
+            elif self.dates:
+                parts = self.dates.split(':')
+                window = None
+                if len(parts) == 2:
+                    (a, b) = parts
+                    (a, b) = (make_date_iso(a), make_date_iso(b))
+                    (a, b) = ISOPARSER.isoparse(a), ISOPARSER.isoparse(b)
+                    window = (a, b)
+                elif len(parts) == 1:
+                    date = ISOPARSER.isoparse(make_date_iso(parts[0]))
+                    window = (date, date)
+                else:
+                    print("Please use --date with argument yyyy-mm-dd:yyyy-mm-dd (from:to) or yyyy-mm-dd.")
+                    return
+                d.drive(window_heuristic=False, date_range=window)
+            else:
+                d.drive(window_heuristic=True)
 
 
 def main():
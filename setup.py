@@ -23,4 +23,5 @@ setup(
             'python-dateutil',
             'pyyaml',
             'requests-oauthlib',
+            'urllib3',
         ])